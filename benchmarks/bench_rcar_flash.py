@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the host-side hot paths of rcar_flash.
+#
+# Everything runs on a plain Linux box: serial ports are emulated with
+# loopback pty pairs, SREC images are generated on the fly and CPLD
+# is driven through a fake pyftdi GPIO backend which counts
+# transactions instead of talking to real hardware.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import pathlib
+import platform
+import sys
+import tempfile
+import threading
+import time
+import types
+from importlib.resources import files
+
+import serial
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+from rcar_flash import rcar_flash  # noqa: E402
+
+DEFAULT_BASELINE = pathlib.Path(__file__).resolve().parent / "baseline.json"
+DEFAULT_SIZES = "64K,1M,16M"
+MB = 1024 * 1024
+# Device output is consumed byte by byte, so there is no point to feed
+# conn_wait_for() with more than this
+WAIT_FOR_MAX_SIZE = MB
+
+# Metrics where bigger value is better. For all other metrics smaller
+# value is better.
+HIGHER_IS_BETTER = ("mb_per_s",)
+# Metrics that do not depend on the host speed. Only these are compared
+# with a baseline recorded on another host.
+HOST_INDEPENDENT = ("usb_transactions_per_cmd", "io_calls_per_prompt", "pipe_writes_per_mb", "tty_writes_per_mb")
+
+
+def parse_size(size: str) -> int:
+    mult = {"K": 1024, "M": MB, "G": 1024 * MB}
+    if size[-1].upper() in mult:
+        return int(size[:-1]) * mult[size[-1].upper()]
+    return int(size)
+
+
+def make_srec(fname, size, load_addr=0x50000000):
+    # Generate S3 records with 16 bytes of data each until file
+    # reaches requested size
+    data = bytes(range(16))
+    data_hex = data.hex().upper()
+    data_sum = sum(data)
+    written = 0
+    with open(fname, "w") as f:
+        header = "S00F0000726361725F666C6173680000D5\n"
+        f.write(header)
+        written += len(header)
+        addr = load_addr
+        lines = []
+        while written < size:
+            count = 4 + len(data) + 1
+            csum = count + sum(addr.to_bytes(4, "big")) + data_sum
+            line = f"S3{count:02X}{addr:08X}{data_hex}{~csum & 0xFF:02X}\n"
+            lines.append(line)
+            written += len(line)
+            addr += len(data)
+            if len(lines) == 4096:
+                f.write("".join(lines))
+                lines = []
+        f.write("".join(lines))
+        f.write(f"S705{load_addr:08X}{~(5 + sum(load_addr.to_bytes(4, 'big'))) & 0xFF:02X}\n")
+
+
+class CountingRaw(io.RawIOBase):
+    """Stands for stdout file descriptor: every write() is one write syscall"""
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.writes += 1
+        self.bytes += len(b)
+        return len(b)
+
+
+@contextlib.contextmanager
+def counting_stdout(tty=False):
+    # Python makes stdout line buffered when it is a terminal and block
+    # buffered when it is a pipe or a file
+    raw = CountingRaw()
+    stream = io.TextIOWrapper(io.BufferedWriter(raw), encoding="utf-8", line_buffering=tty)
+    with contextlib.redirect_stdout(stream):
+        yield raw
+    stream.flush()
+
+
+class CountingSerial:
+    """Proxy for serial.Serial which counts read() and write() calls"""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.reads = 0
+        self.writes = 0
+
+    def read(self, size=1):
+        self.reads += 1
+        return self._conn.read(size)
+
+    def write(self, data):
+        self.writes += 1
+        return self._conn.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class PtyPair:
+    """Loopback pty pair. `conn` is used by rcar_flash, `master` is the device side"""
+
+    def __init__(self, baud=115200, timeout=20):
+        self.master, slave = os.openpty()
+        self.conn = serial.Serial(port=os.ttyname(slave), baudrate=baud, timeout=timeout)
+        os.close(slave)
+
+    def close(self):
+        self.conn.close()
+        os.close(self.master)
+
+
+def drain(fd, total, out):
+    received = 0
+    while received < total:
+        received += len(os.read(fd, 64 * 1024))
+    out.append(received)
+
+
+def feed(fd, data):
+    view = memoryview(data)
+    while view:
+        n = os.write(fd, view)
+        view = view[n:]
+
+
+def measure(func, repeat=1):
+    # Return the best of `repeat` runs to filter out noise
+    best_wall = best_cpu = float("inf")
+    for _ in range(repeat):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        func()
+        best_wall = min(best_wall, time.perf_counter() - wall)
+        best_cpu = min(best_cpu, time.process_time() - cpu)
+    return best_wall, best_cpu
+
+
+def bench_srec_load_addr(tmpdir, sizes):
+    results = {}
+    for size in sizes:
+        fname = os.path.join(tmpdir, f"image_{size}.srec")
+        make_srec(fname, size)
+        wall, cpu = measure(lambda: rcar_flash.get_srec_load_addr(fname), repeat=5)
+        results[f"get_srec_load_addr/{size}"] = {
+            "mb_per_s": size / MB / wall,
+            "cpu_s_per_mb": cpu / (size / MB),
+        }
+        os.unlink(fname)
+    return results
+
+
+def bench_send_data(sizes):
+    results = {}
+    for size in sizes:
+        data = b"S3" * (size // 2)
+        metrics = {}
+        for stdout in ("pipe", "tty"):
+            pty = PtyPair()
+            received = []
+            reader = threading.Thread(target=drain, args=(pty.master, len(data), received))
+            reader.start()
+            with counting_stdout(tty=stdout == "tty") as raw:
+                wall, cpu = measure(lambda: rcar_flash.send_data_with_progress(data, pty.conn))
+            reader.join()
+            pty.close()
+            metrics[f"{stdout}_writes_per_mb"] = raw.writes / (size / MB)
+            # Timings are taken with stdout being a pipe
+            if stdout == "pipe":
+                metrics["mb_per_s"] = size / MB / wall
+                metrics["cpu_s_per_mb"] = cpu / (size / MB)
+        results[f"send_data_with_progress/{size}"] = metrics
+    return results
+
+
+def bench_wait_for(sizes):
+    # Emulate MiniMonitor which prints a banner and then a prompt. Prompts are
+    # repeated until requested amount of device output is consumed.
+    banner = b"Flash writer for R-Car Gen3 Series V1.00 Jan.01,2024\r\n" * 20
+    prompt = "Please Input : H'"
+    chunk = banner + prompt.encode("ascii")
+    results = {}
+    for mode in rcar_flash.console_mirror.MODES:
+        for size in sorted({min(x, WAIT_FOR_MAX_SIZE) for x in sizes}):
+            prompts = max(1, size // len(chunk))
+            pty = PtyPair()
+            conn = CountingSerial(pty.conn)
+            writer = threading.Thread(target=feed, args=(pty.master, chunk * prompts))
+            writer.start()
+
+            with counting_stdout(tty=True) as raw:
+                console = rcar_flash.console_mirror(mode)
+
+                def run():
+                    for _ in range(prompts):
+                        rcar_flash.conn_wait_for(conn, prompt, console)
+
+                wall, cpu = measure(run)
+            writer.join()
+            pty.close()
+            total = len(chunk) * prompts
+            results[f"conn_wait_for/{mode}/{size}"] = {
+                "mb_per_s": total / MB / wall,
+                "cpu_s_per_mb": cpu / (total / MB),
+                # Calls to serial read() and stdout writes, not syscalls:
+                # pyserial does both select() and read() for every byte
+                "io_calls_per_prompt": (conn.reads + raw.writes) / prompts,
+            }
+    return results
+
+
+class FakeGpio:
+    """Fake pyftdi GPIO controller that counts USB transactions"""
+
+    def __init__(self):
+        self.transactions = 0
+        self.samples = 0
+        self.exchanges = []
+        self.direction = 0
+        self.ftdi = types.SimpleNamespace(fifo_sizes=(256, 128))
+
+    def configure(self, url, direction=0, initial=0, frequency=None):
+        self.direction = direction
+
+    def close(self):
+        pass
+
+    # GpioSyncController
+    def exchange(self, out):
+        self.transactions += 1
+        self.samples += len(out)
+        self.exchanges.append(bytes(out))
+        return bytes(len(out))
+
+    # GpioAsyncController
+    def set_direction(self, pins, direction):
+        self.transactions += 1
+        self.direction = direction
+
+    def read(self):
+        # Keep SCL high and SDA low, so every byte gets ACK
+        self.transactions += 1
+        return rcar_flash.cpld_i2c.SCL_PIN
+
+
+@contextlib.contextmanager
+def fake_pyftdi():
+    gpios = []
+
+    def factory():
+        gpio = FakeGpio()
+        gpios.append(gpio)
+        return gpio
+
+    module = types.ModuleType("pyftdi.gpio")
+    module.GpioSyncController = factory
+    module.GpioAsyncController = factory
+    package = sys.modules.get("pyftdi") or types.ModuleType("pyftdi")
+    saved = {name: sys.modules.get(name) for name in ("pyftdi", "pyftdi.gpio")}
+    saved_attr = getattr(package, "gpio", None)
+    sys.modules["pyftdi"] = package
+    sys.modules["pyftdi.gpio"] = module
+    package.gpio = module
+    try:
+        yield gpios
+    finally:
+        for name, mod in saved.items():
+            if mod is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = mod
+        if saved_attr is None:
+            del package.gpio
+        else:
+            package.gpio = saved_attr
+
+
+def legacy_spi_exchanges(profile, script):
+    # Exchanges that cpld_spi issued when it built waveforms bit by bit
+    spi = rcar_flash.cpld_spi
+
+    def write_byte(byte):
+        wave = bytearray()
+        for i in range(7, -1, -1):
+            mosi = spi.MOSI_PIN if byte & (1 << i) else 0
+            wave += bytes([mosi | spi.CS_PIN | spi.SCK_PIN, mosi | spi.CS_PIN])
+        return wave
+
+    sync = bytearray([spi.SCK_PIN, 0])
+    sync += bytes([spi.CS_PIN | spi.SCK_PIN, spi.CS_PIN]) * 32
+    sync += bytes([spi.CS_PIN | spi.SCK_PIN | spi.MOSI_PIN, spi.CS_PIN | spi.MOSI_PIN])
+    exchanges = [sync, write_byte(0xfe) + bytes([spi.SCK_PIN | spi.MOSI_PIN, spi.MOSI_PIN])]
+    for cmd in script:
+        data = bytearray([spi.SCK_PIN, 0])
+        for i in range(3, -1, -1):
+            data += write_byte(profile[cmd]["write"] >> (i * 8))
+        exchanges.append(data)
+        exchanges.append(write_byte(profile[cmd]["reg"]) + bytes([spi.MOSI_PIN | spi.SCK_PIN, spi.MOSI_PIN]))
+    return [bytes(x) for x in exchanges]
+
+
+def check_spi_waveform(profile, script, exchanges):
+    if exchanges != legacy_spi_exchanges(profile, script):
+        raise Exception("CPLD SPI exchanges do not match the legacy ones")
+
+
+def bench_cpld(conf, iterations=10):
+    script = ["serial_mode", "reset"]
+    results = {}
+    logger = rcar_flash.log
+    level = logger.level
+    logger.setLevel("WARNING")
+    try:
+        for profile_name in ("ulcb", "s4"):
+            profile = conf["cpld_profiles"][profile_name]
+            with fake_pyftdi() as gpios:
+                cpld = rcar_flash.cpld_get_instance("FAKE", profile)
+                gpio = gpios[0]
+                gpio.transactions = 0
+                cpld.write_script(script)
+                transactions = gpio.transactions
+                if profile["protocol"] == "spi":
+                    check_spi_waveform(profile, script, gpio.exchanges)
+
+                def run():
+                    for _ in range(iterations):
+                        cpld.write_script(script)
+
+                wall, cpu = measure(run, repeat=5)
+            results[f"cpld_{profile['protocol']}/{profile_name}"] = {
+                "usb_transactions_per_cmd": transactions / len(script),
+                "us_per_cmd": wall * 1e6 / (iterations * len(script)),
+            }
+    finally:
+        logger.setLevel(level)
+    return results
+
+
+def portable_results(results):
+    portable = {}
+    for name, metrics in results.items():
+        metrics = {metric: value for metric, value in metrics.items() if metric in HOST_INDEPENDENT}
+        if metrics:
+            portable[name] = metrics
+    return portable
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    if baseline.get("host") != platform.node():
+        results = portable_results(results)
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline["results"].get(name, {}).get(metric)
+            if base is None or base == 0:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                change = (base - value) / base
+            else:
+                change = (value - base) / base
+            if change > tolerance:
+                regressions.append((name, metric, base, value, change))
+    return regressions
+
+
+def print_results(results):
+    row_format = "{:<36} {:<26} {:>14}"
+    header = row_format.format("Benchmark", "Metric", "Value")
+    print(header)
+    print("-" * len(header))
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            print(row_format.format(name, metric, f"{value:.3f}"))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for rcar_flash host-side hot paths')
+    parser.add_argument('--sizes',
+                        default=DEFAULT_SIZES,
+                        help=f'Comma-separated list of image sizes. Default is "{DEFAULT_SIZES}"')
+    parser.add_argument('--baseline',
+                        type=pathlib.Path,
+                        default=DEFAULT_BASELINE,
+                        help='Baseline file to compare results with')
+    parser.add_argument('--save-baseline',
+                        action='store_true',
+                        help='Store results as a new baseline instead of comparing')
+    parser.add_argument('--portable',
+                        action='store_true',
+                        help='With --save-baseline: store only metrics that do not depend on the host')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.25,
+                        help='Allowed relative regression. Default is 0.25')
+    parser.add_argument('--only',
+                        choices=["srec", "send", "wait", "cpld"],
+                        action='append',
+                        help='Run only selected benchmark(s)')
+    args = parser.parse_args()
+
+    sizes = [parse_size(x) for x in args.sizes.split(",")]
+    with open(files("rcar_flash").joinpath("rcar_flash.yaml")) as f:
+        conf = rcar_flash.read_config(f)
+
+    results = {}
+    selected = args.only or ["srec", "send", "wait", "cpld"]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if "srec" in selected:
+            results.update(bench_srec_load_addr(tmpdir, sizes))
+    if "send" in selected:
+        results.update(bench_send_data(sizes))
+    if "wait" in selected:
+        results.update(bench_wait_for(sizes))
+    if "cpld" in selected:
+        results.update(bench_cpld(conf))
+
+    print_results(results)
+
+    if args.save_baseline:
+        if args.portable:
+            baseline = {"host": None, "results": portable_results(results)}
+        else:
+            baseline = {"host": platform.node(), "results": results}
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not args.baseline.exists():
+        print(f"No baseline at {args.baseline}, nothing to compare with")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for name, metric, base, value, change in regressions:
+        print(f"REGRESSION: {name} {metric}: {base:.3f} -> {value:.3f} ({change:+.0%})")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,6 +9,8 @@ import argparse
 import pathlib
 import traceback
 import time
+import json
+import sys
 from string import printable
 from importlib.resources import files
 
@@ -16,6 +18,10 @@ logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 log = logging.getLogger(__name__)
 cpld_available = False
 
+# Delays used when board is switched into serial download mode with CPLD
+CPLD_RESET_DELAY = 0.5
+CPLD_PORT_DELAY = 1
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -34,6 +40,11 @@ def main():
         epilog='Each loader has format loader_name[:file_name], by default file name'
         'is taken from YAML configuration file'
     )
+    parser_plan = subparsers.add_parser(
+        name="plan",
+        help="Estimate how long flashing of loaders will take without touching a board",
+        epilog='Accepts the same loaders as "flash" sub-command'
+    )
     parser_list_loaders = subparsers.add_parser(
         name="list-loaders", help="List supported loaders for a board")
     subparsers.add_parser(name="list-boards",
@@ -69,6 +80,34 @@ def main():
 
     parser_flash.add_argument('-s', '--serial', help='Serial console to use')
 
+    parser_flash.add_argument(
+        '--console',
+        choices=console_mirror.MODES,
+        default="line",
+        help='How to mirror device output: "quiet" - do not print it, "line" - print it line by line, '
+        '"live" - print every character as soon as it is received. Default is "line"')
+
+    parser_flash.add_argument(
+        '--console-tail',
+        metavar='KB',
+        type=positive_int,
+        default=4,
+        help='Amount of the last device output to show in "quiet" mode when device does not respond. Default is 4 KB')
+
+    parser_flash.add_argument(
+        '-t',
+        '--transcript',
+        type=pathlib.Path,
+        default=None,
+        help='Write full device output to a file')
+
+    parser_flash.add_argument(
+        '-r',
+        '--report',
+        type=pathlib.Path,
+        default=None,
+        help='Write run report in JSON format. It can be used to calibrate "plan" sub-command')
+
     parser_flash.add_argument('-b',
                               '--board',
                               type=str,
@@ -87,6 +126,52 @@ def main():
         nargs='+',
         help='List of loaders to flash or "all" to flash all')
 
+    parser_plan.add_argument('-b',
+                             '--board',
+                             type=str,
+                             required=True,
+                             help='Board name')
+
+    parser_plan.add_argument('-c',
+                             '--cpld',
+                             action='store_true',
+                             help='Account for switching a board to a flash mode with CPLD')
+
+    parser_plan.add_argument(
+        '-f',
+        '--flash-writer',
+        metavar="flashwriter.mot",
+        nargs='?',
+        type=str,
+        default=None,
+        const="DEFAULT",
+        help='Account for uploading of Flash Writer. Default name is read from YAML configuration file'
+    )
+
+    parser_plan.add_argument('-p',
+                             '--path',
+                             type=pathlib.Path,
+                             default='.',
+                             help='Path where loaders are located')
+
+    parser_plan.add_argument(
+        '--calibrate',
+        metavar='report.json',
+        action='append',
+        type=argparse.FileType('r'),
+        default=[],
+        help='Run report written by "flash --report" to learn flash times from. Can be used multiple times')
+
+    parser_plan.add_argument('--json',
+                             action='store_true',
+                             help='Print plan in JSON format')
+
+    parser_plan.add_argument(
+        'loaders',
+        metavar='loaders',
+        nargs='+',
+        help='List of loaders to flash or "all" to flash all')
+
     args = parser.parse_args()
     log.info(f"Using configuration file: {args.conf.name}")
 
@@ -94,6 +179,7 @@ def main():
         "list-loaders": do_list_loaders,
         "list-boards": do_list_boards,
         "flash": do_flash,
+        "plan": do_plan,
     }
 
     if args.action not in actions:
@@ -103,6 +189,13 @@ def main():
     actions[args.action](config, args)
 
 
+def positive_int(value):
+    ret = int(value)
+    if ret <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return ret
+
+
 def read_config(stream):
     return yaml.load(stream, Loader=yaml.Loader)
 
@@ -144,10 +237,7 @@ def do_list_boards(conf, args):
         print(row_format.format(b, conf["board"][b]["flash_writer"]))
 
 
-def do_flash(conf, args):  # noqa: C901
-    board = get_board(conf, args.board)
-
-    # Do some sanity checks before tring to flash anything
+def get_loaders(board, args):
     # Build list of loaders
     loaders: dict[str, str] = dict()
     loader_arg: str
@@ -184,6 +274,34 @@ def do_flash(conf, args):  # noqa: C901
                 raise Exception(
                     f"File {ipl_file} for loader {ipl_name} does not exists!")
             loaders[ipl_name] = ipl_file
+    return loaders
+
+
+def get_cpld_profile(conf, board):
+    if "cpld_profile" not in board:
+        raise Exception(
+            "'cpld_profile' is not set for board, can't control CPLD")
+    return conf["cpld_profiles"][board["cpld_profile"]]
+
+
+def get_flash_writer_path(board, args):
+    if args.flash_writer == "DEFAULT":
+        flash_writer_file_name = board["flash_writer"]
+        flash_writer_file_path = files("rcar_flash").joinpath(flash_writer_file_name)
+        if not os.path.exists(flash_writer_file_path):
+            raise Exception(f"Flash writer file {flash_writer_file_path} does not exist in package resources.")
+    else:
+        flash_writer_file_path = args.flash_writer
+    if not os.path.exists(flash_writer_file_path):
+        raise Exception(f"Flash writer file not found at specified path: {args.flash_writer}")
+    return flash_writer_file_path
+
+
+def do_flash(conf, args):  # noqa: C901
+    board = get_board(conf, args.board)
+
+    # Do some sanity checks before tring to flash anything
+    loaders = get_loaders(board, args)
 
     log.info("We are going to flash the following loaders")
     log.info("---")
@@ -195,76 +313,213 @@ def do_flash(conf, args):  # noqa: C901
     if args.cpld:
         if not cpld_available:
             raise Exception("pyftdi is not available")
-        if "cpld_profile" not in board:
-            raise Exception(
-                "'cpld_profile' is not set for board, can't control CPLD")
+        cpld_profile = get_cpld_profile(conf, board)
 
         # Force enable uploading flash_writer, otherwise it have no sense
         # to use CPLD
         if not args.flash_writer:
             args.flash_writer = "DEFAULT"
 
-        cpld_profile = conf["cpld_profiles"][board["cpld_profile"]]
         dev_serial = cpld_determine_serial(cpld_profile, args)
         args.cpld = dev_serial
         cpld = cpld_get_instance(dev_serial, cpld_profile)
         cpld.check_rev()
-        cpld.serial_mode()
-        cpld.reset()
-        time.sleep(0.5)
+        cpld.write_script(["serial_mode", "reset"])
+        time.sleep(CPLD_RESET_DELAY)
         # Need to release port, so pyserial can use it
         del cpld
         # Let's give some time for the proper recreation
         # of the serial device and possible udev links
-        time.sleep(1)
+        time.sleep(CPLD_PORT_DELAY)
 
     conn = open_connection(board, args)
-    # Upload flash writer if needed
-    if args.flash_writer:
-        if not args.cpld:
-            log.info("Please ensure that board is in the serial download mode")
-        if args.flash_writer == "DEFAULT":
-            flash_writer_file_name = board["flash_writer"]
-            flash_writer_file_path = files("rcar_flash").joinpath(flash_writer_file_name)
-            if not os.path.exists(flash_writer_file_path):
-                raise Exception(f"Flash writer file {flash_writer_file_path} does not exist in package resources.")
+    # Transcript should be complete even if flashing fails
+    with console_mirror(args.console, args.console_tail * 1024, args.transcript) as console:
+        report = {"board": args.board, "flash_writer": None, "loaders": []}
+        # Upload flash writer if needed
+        if args.flash_writer:
+            if not args.cpld:
+                log.info("Please ensure that board is in the serial download mode")
+            flash_writer_file_path = get_flash_writer_path(board, args)
+            log.info(f"Sending flash writer file {flash_writer_file_path}...")
+            phase_start = time.monotonic()
+            send_flashwriter(board, flash_writer_file_path, conn, console)
+            report["flash_writer"] = {
+                "bytes": os.path.getsize(flash_writer_file_path),
+                "baud": conn.baudrate,
+                "seconds": time.monotonic() - phase_start,
+            }
+            if "sup_baud" in board:
+                # Increase comm speed if SUP command is available
+                conn_send(conn, "sup\r")
+                conn.close()
+                conn = open_connection(board, args, use_sup=True)
         else:
-            flash_writer_file_path = args.flash_writer
-        if not os.path.exists(flash_writer_file_path):
-            raise Exception(f"Flash writer file not found at specified path: {args.flash_writer}")
-        log.info(f"Sending flash writer file {flash_writer_file_path}...")
-        send_flashwriter(board, flash_writer_file_path, conn)
-        if "sup_baud" in board:
-            # Increase comm speed if SUP command is available
-            conn_send(conn, "sup\r")
-            conn.close()
-            conn = open_connection(board, args, use_sup=True)
-    else:
-        log.info("Please ensure that board is in Monitor mode")
-
-    # Upload files one by one
-    for k in loaders.keys():
-        ipl_entry = board["ipls"][k]
-        addr = ipl_entry["flash_addr"]
-        flash_target = conf["flash_target"][ipl_entry["flash_target"]]
-        log.info(
-            f"Writing {k} ({loaders[k]}) at 0x{addr:x} using {ipl_entry['flash_target']}"
-        )
-        flash_one_loader(conn, loaders[k], addr, flash_target)
+            log.info("Please ensure that board is in Monitor mode")
+
+        # Upload files one by one
+        for k in loaders.keys():
+            ipl_entry = board["ipls"][k]
+            addr = ipl_entry["flash_addr"]
+            flash_target = conf["flash_target"][ipl_entry["flash_target"]]
+            log.info(
+                f"Writing {k} ({loaders[k]}) at 0x{addr:x} using {ipl_entry['flash_target']}"
+            )
+            phase_start = time.monotonic()
+            flash_one_loader(conn, loaders[k], addr, flash_target, console)
+            report["loaders"].append({
+                "name": k,
+                "flash_target": ipl_entry["flash_target"],
+                "bytes": os.path.getsize(loaders[k]),
+                "baud": conn.baudrate,
+                "seconds": time.monotonic() - phase_start,
+            })
 
-    conn.close()
+        conn.close()
 
     log.info("All done!")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+        log.info(f"Run report is written to {args.report}")
     # loaders are empty if user specified "none" and this means
     # that user wants to work with flash_writer, so we do not reset port
     if args.cpld and loaders:
         cpld = cpld_get_instance(dev_serial, cpld_profile)
-        cpld.normal_mode()
-        cpld.reset()
+        cpld.write_script(["normal_mode", "reset"])
     else:
         log.info("You might need to reboot your board")
 
 
+def estimate_transfer_time(size, baud):
+    # 8N1: every byte takes 10 bits on the wire
+    return size * 10 / baud
+
+
+def fit_flash_time(samples):
+    """Fit non-transfer time of flash target as `overhead + size / rate`
+
+    `samples` is a list of (size, seconds) pairs. Least squares fit is
+    used. When sizes do not vary, rate can't be told from overhead, so
+    all time is attributed to overhead: this overestimates time for
+    bigger loaders rather than underestimates it for smaller ones.
+    Returns (overhead, rate) tuple, rate is None when there is no per-byte
+    term.
+    """
+    n = len(samples)
+    sx = sum(x for x, _ in samples)
+    sy = sum(y for _, y in samples)
+    sxx = sum(x * x for x, _ in samples)
+    sxy = sum(x * y for x, y in samples)
+    d = n * sxx - sx * sx
+    if d > 0:
+        slope = (n * sxy - sx * sy) / d
+        overhead = (sy - slope * sx) / n
+        if slope > 0 and overhead >= 0:
+            return overhead, 1 / slope
+        if slope > 0:
+            # Negative overhead has no sense, fit rate only
+            return 0, sxx / sxy
+    return max(sy / n, 0), None
+
+
+def calibrate_flash_times(reports):
+    """Learn non-transfer flash time of each flash target from run reports"""
+    samples = {}
+    for report in reports:
+        for entry in report["loaders"]:
+            seconds = entry["seconds"] - estimate_transfer_time(entry["bytes"], entry["baud"])
+            samples.setdefault(entry["flash_target"], []).append((entry["bytes"], seconds))
+    return {target: fit_flash_time(target_samples) for target, target_samples in samples.items()}
+
+
+def plan_phase(name, size, baud, flash_time=None):
+    transfer = estimate_transfer_time(size, baud)
+    flash = 0
+    if flash_time:
+        overhead, rate = flash_time
+        flash = overhead + (size / rate if rate else 0)
+    return {
+        "name": name,
+        "bytes": size,
+        "baud": baud,
+        "transfer_seconds": transfer,
+        # Time spent by the board besides receiving data: prompts, erase
+        # and write
+        "flash_seconds": flash,
+        "settle_seconds": 0,
+        "seconds": transfer + flash,
+        # Estimate does not include flash time, so real time will be longer
+        "lower_bound": False,
+    }
+
+
+def do_plan(conf, args):
+    board = get_board(conf, args.board)
+    loaders = get_loaders(board, args)
+
+    # The same as for "flash": it has no sense to use CPLD without flash writer
+    if args.cpld:
+        get_cpld_profile(conf, board)
+        if not args.flash_writer:
+            args.flash_writer = "DEFAULT"
+
+    flash_times = {
+        name: (target.get("flash_overhead", 0), target.get("flash_rate"))
+        for name, target in conf["flash_target"].items()
+        if "flash_overhead" in target or "flash_rate" in target
+    }
+    flash_times.update(calibrate_flash_times([json.load(f) for f in args.calibrate]))
+
+    phases = []
+    if args.cpld:
+        # Nothing is sent over serial port, board just needs time to reset
+        phases.append({
+            "name": "cpld",
+            "bytes": 0,
+            "baud": None,
+            "transfer_seconds": 0,
+            "flash_seconds": 0,
+            "settle_seconds": CPLD_RESET_DELAY + CPLD_PORT_DELAY,
+            "seconds": CPLD_RESET_DELAY + CPLD_PORT_DELAY,
+            "lower_bound": False,
+        })
+    if args.flash_writer:
+        flash_writer_file_path = get_flash_writer_path(board, args)
+        phases.append(plan_phase("flash_writer", os.path.getsize(flash_writer_file_path), get_baud(board)))
+    loader_baud = get_baud(board, use_sup=bool(args.flash_writer))
+    for k in loaders.keys():
+        target = board["ipls"][k]["flash_target"]
+        phase = plan_phase(k, os.path.getsize(loaders[k]), loader_baud, flash_times.get(target))
+        if target not in flash_times:
+            log.warning(f"Flash time for {target} is unknown, estimate for {k} covers only transfer time")
+            phase["lower_bound"] = True
+        phases.append(phase)
+    total = sum(phase["seconds"] for phase in phases)
+    lower_bound = any(phase["lower_bound"] for phase in phases)
+
+    if args.json:
+        print(json.dumps({"board": args.board, "phases": phases, "total_seconds": total,
+                          "lower_bound": lower_bound}, indent=2))
+        return
+
+    row_format = "{:<24}     {:>12}     {:>8}     {:>12}     {:>12}     {:>10}     {:>12}"
+    header = row_format.format("Phase", "Bytes", "Baud", "Transfer, s", "Flash, s", "Settle, s", "Total, s")
+    print(header)
+    print("-" * len(header))
+    for phase in phases:
+        # Mark estimates that do not include flash time
+        prefix = ">=" if phase["lower_bound"] else ""
+        flash = "?" if phase["lower_bound"] else f'{phase["flash_seconds"]:.1f}'
+        baud = phase["baud"] if phase["baud"] else "-"
+        print(row_format.format(phase["name"], phase["bytes"], baud,
+                                f'{phase["transfer_seconds"]:.1f}', flash, f'{phase["settle_seconds"]:.1f}',
+                                f'{prefix}{phase["seconds"]:.1f}'))
+    print("-" * len(header))
+    prefix = ">=" if lower_bound else ""
+    print(row_format.format("Total", "", "", "", "", "", f"{prefix}{total:.1f}"))
+
+
 def send_data_with_progress(data, conn: serial.Serial, print_progress=True):
     bytes_sent = 0
     total = len(data)
@@ -283,7 +538,7 @@ def send_data_with_progress(data, conn: serial.Serial, print_progress=True):
         print("")
 
 
-def flash_one_loader(conn, fname, flash_addr, flash_target):
+def flash_one_loader(conn, fname, flash_addr, flash_target, console):
     conn_send(conn, "\r")
 
     orig_timeout: int
@@ -292,7 +547,7 @@ def flash_one_loader(conn, fname, flash_addr, flash_target):
             # set required timeout
             orig_timeout = conn.timeout
             conn.timeout = evt["timeout"]
-        conn_wait_for(conn, evt["wait_for"])
+        conn_wait_for(conn, evt["wait_for"], console)
         if "timeout" in evt:
             # restore original timeout
             conn.timeout = orig_timeout
@@ -310,14 +565,14 @@ def flash_one_loader(conn, fname, flash_addr, flash_target):
                 send_data_with_progress(data, conn)
         else:
             raise Exception(f"Unknown value to send: {evt['send']}")
-    conn_wait_for(conn, ">")
+    conn_wait_for(conn, ">", console)
 
 
-def send_flashwriter(board_conf, fname: str, conn: serial.Serial):
+def send_flashwriter(board_conf, fname: str, conn: serial.Serial, console):
     with open(fname, "rb") as f:
         data = f.read()
     send_data_with_progress(data, conn)
-    conn_wait_for(conn, ">")
+    conn_wait_for(conn, ">", console)
 
 
 def open_connection(board_conf, args, use_sup=False):
@@ -334,13 +589,7 @@ def open_connection(board_conf, args, use_sup=False):
         else:
             raise Exception(
                 f"Can't find device with serial number {serial_no}")
-    if use_sup and "sup_baud" in board_conf:
-        # use SUP if requested and available
-        baud = board_conf["sup_baud"]
-    elif "baud" in board_conf:
-        baud = board_conf["baud"]
-    else:
-        baud = 115200
+    baud = get_baud(board_conf, use_sup)
 
     log.info(f"Using serial port {dev_name} with baudrate {baud}")
     conn = serial.Serial(port=dev_name, baudrate=baud, timeout=20)
@@ -351,16 +600,97 @@ def open_connection(board_conf, args, use_sup=False):
     return conn
 
 
-def conn_wait_for(conn, expect: str):
+def get_baud(board_conf, use_sup=False):
+    if use_sup and "sup_baud" in board_conf:
+        # use SUP if requested and available
+        return board_conf["sup_baud"]
+    return board_conf.get("baud", 115200)
+
+
+def conn_wait_for(conn, expect: str, console):
     rcv_str = ""
-    while expect not in rcv_str:
+    # Only the last received char can complete the match, so it is
+    # enough to keep the last len(expect) chars
+    while not rcv_str.endswith(expect):
         data = conn.read(1)
         if not data:
-            raise TimeoutError(f"Timeout waiting for `{expect}` from the device")
-        rcv_char = chr(data[0])
-        if rcv_char in printable or rcv_char == '\b':
-            print(rcv_char, end='', flush=True)
-        rcv_str += rcv_char
+            console.flush()
+            msg = f"Timeout waiting for `{expect}` from the device"
+            # Otherwise last output is already shown
+            if console.quiet:
+                msg += f". Last device output:\n{console.tail()}"
+            raise TimeoutError(msg)
+        console.feed(data)
+        rcv_str = (rcv_str + chr(data[0]))[-len(expect):]
+    # Prompts usually do not end with a newline, so show them right away
+    console.flush()
+
+
+class console_mirror:
+    """Mirrors device output to stdout and, optionally, to a transcript file.
+
+    In "line" mode output is written once per line, instead of once per
+    char, which matters a lot when stdout is a slow pipe. The last
+    `tail_size` bytes are always kept to be shown in error reports when
+    output is not mirrored to stdout.
+    """
+    MODES = ("quiet", "line", "live")
+    # Chars that are not echoed to stdout
+    NON_PRINTABLE = bytes(x for x in range(256) if chr(x) not in printable and chr(x) != '\b')
+
+    def __init__(self, mode="line", tail_size=4096, transcript=None):
+        self._pending = bytearray()
+        self._transcript = None
+        if mode not in self.MODES:
+            raise Exception(f"Unknown console mode '{mode}'")
+        if tail_size <= 0:
+            raise Exception(f"Console tail size should be positive, got {tail_size}")
+        self._mode = mode
+        self._tail_size = tail_size
+        self._tail = bytearray()
+        if transcript:
+            self._transcript = open(transcript, "wb")
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def quiet(self):
+        return self._mode == "quiet"
+
+    def feed(self, data: bytes):
+        self._tail += data
+        # Trim ring buffer only once in a while to make it cheap
+        if len(self._tail) > 2 * self._tail_size:
+            del self._tail[:-self._tail_size]
+        if self._transcript:
+            self._transcript.write(data)
+        if self._mode == "quiet":
+            return
+        self._pending += data.translate(None, self.NON_PRINTABLE)
+        if self._mode == "live" or b"\n" in data:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            sys.stdout.write(self._pending.decode("ascii"))
+            sys.stdout.flush()
+            self._pending.clear()
+
+    def tail(self) -> str:
+        return self._tail[-self._tail_size:].decode("ascii", errors="replace")
+
+    def close(self):
+        self.flush()
+        if self._transcript:
+            self._transcript.close()
+            self._transcript = None
 
 
 def conn_send(conn, data):
@@ -502,6 +832,10 @@ class cpld_i2c:
         reg_data = cmd_conf["write"]
         self._write_regs(self._devaddr, reg_addr, reg_data)
 
+    def write_script(self, cmds):
+        for cmd in cmds:
+            self.write_cmd(cmd)
+
     def _sleep(self):
         time.sleep(0.0001)
 
@@ -632,6 +966,19 @@ class cpld_spi:
     MOSI_PIN = 0x40
     MISO_PIN = 0x10
     SCK_PIN = 0x04
+    FREQUENCY = 57600
+
+    # Precomputed waveforms for every byte value. Each bit is clocked out
+    # MSB first as two samples: SCK high, then SCK low.
+    _BYTE_WAVEFORMS = []
+    for _byte in range(256):
+        _wave = bytearray()
+        for _bit in range(7, -1, -1):
+            _mosi = MOSI_PIN if _byte & (1 << _bit) else 0
+            _wave.append(_mosi | CS_PIN | SCK_PIN)
+            _wave.append(_mosi | CS_PIN)
+        _BYTE_WAVEFORMS.append(bytes(_wave))
+    del _byte, _bit, _mosi, _wave
 
     def __init__(self, serial: str, profile: dict):
         import pyftdi.gpio
@@ -639,10 +986,14 @@ class cpld_spi:
         gpio.configure(f'ftdi://ftdi:232r:{serial}/1',
                        direction=self.CS_PIN | self.MOSI_PIN | self.SCK_PIN,
                        initial=0,
-                       frequency=57600)
+                       frequency=self.FREQUENCY)
         self._gpio = gpio
+        # In synchronous bitbang mode chip returns one sample for every
+        # byte written, so single exchange should fit into FIFO
+        self._max_exchange = min(gpio.ftdi.fifo_sizes)
         self._profile = profile
-        self._sync()
+        # Sync sequence will be sent together with the first command
+        self._pending = self._prepare_sync()
 
     def __del__(self):
         self._gpio.close()
@@ -660,52 +1011,63 @@ class cpld_spi:
         log.info("CPLD SPI protocol does not support revision check")
 
     def write_cmd(self, cmd):
-        log.info("CPLD: Issuing command %s", cmd)
-        cmd_conf = self._profile[cmd]
-        reg_addr = cmd_conf["reg"]
-        reg_data = cmd_conf["write"]
-        self._write_reg(reg_addr, reg_data)
+        self.write_script([cmd])
+
+    def write_script(self, cmds):
+        """Issue list of commands.
+
+        Waveforms for all commands are prepared upfront and then sent
+        back to back. Returns number of USB exchanges issued.
+        """
+        segments = self._pending
+        self._pending = []
+        for cmd in cmds:
+            log.info("CPLD: Issuing command %s", cmd)
+            cmd_conf = self._profile[cmd]
+            segments += self._prepare_write_reg(cmd_conf["reg"], cmd_conf["write"])
+        exchanges = 0
+        for segment in segments:
+            exchanges += self._exchange(segment)
+        log.info("CPLD: %d command(s) sent using %d USB exchange(s)",
+                 len(cmds), exchanges)
+        return exchanges
+
+    def _exchange(self, wave):
+        exchanges = 0
+        for offset in range(0, len(wave), self._max_exchange):
+            self._gpio.exchange(wave[offset:offset + self._max_exchange])
+            exchanges += 1
+        # CPLD timing requirements are not known, so keep the same gap
+        # between segments as before: USB round trip plus a short sleep
+        self._sleep()
+        return exchanges
 
     def _sleep(self):
         time.sleep(0.00001)
 
     def _prepare_write_byte(self, byte):
-        cmd = []
-        for i in range(7, -1, -1):
-            if byte & (1 << i):
-                mosi = self.MOSI_PIN
-            else:
-                mosi = 0
-            cmd.append(mosi | self.CS_PIN | self.SCK_PIN)
-            cmd.append(mosi | self.CS_PIN)
-        return cmd
-
-    def _sync(self):
-        cmd = [self.SCK_PIN, 0]
-        for _ in range(32):
-            cmd.append(self.CS_PIN | self.SCK_PIN)
-            cmd.append(self.CS_PIN)
+        return self._BYTE_WAVEFORMS[byte & 0xFF]
+
+    # Waveforms are returned as lists of segments. Each segment is sent
+    # with a separate exchange.
+    def _prepare_sync(self):
+        cmd = bytearray([self.SCK_PIN, 0])
+        cmd += bytes([self.CS_PIN | self.SCK_PIN, self.CS_PIN]) * 32
         cmd.append(self.CS_PIN | self.SCK_PIN | self.MOSI_PIN)
         cmd.append(self.CS_PIN | self.MOSI_PIN)
-        self._gpio.exchange(cmd)
-        self._sleep()
-        cmd = self._prepare_write_byte(0xfe)
-        cmd.append(self.SCK_PIN | self.MOSI_PIN)
-        cmd.append(self.MOSI_PIN)
-        self._gpio.exchange(cmd)
+        trailer = bytearray(self._prepare_write_byte(0xfe))
+        trailer.append(self.SCK_PIN | self.MOSI_PIN)
+        trailer.append(self.MOSI_PIN)
+        return [cmd, trailer]
 
-    def _write_reg(self, addr, reg):
-        cmd = [self.SCK_PIN, 0]
+    def _prepare_write_reg(self, addr, reg):
+        cmd = bytearray([self.SCK_PIN, 0])
         for i in range(3, -1, -1):
-            cmd.extend(self._prepare_write_byte(reg >> (i * 8)))
-
-        self._gpio.exchange(cmd)
-        self._sleep()
-
-        cmd = self._prepare_write_byte(addr)
-        cmd.append(self.MOSI_PIN | self.SCK_PIN)
-        cmd.append(self.MOSI_PIN)
-        self._gpio.exchange(cmd)
+            cmd += self._prepare_write_byte(reg >> (i * 8))
+        latch = bytearray(self._prepare_write_byte(addr))
+        latch.append(self.MOSI_PIN | self.SCK_PIN)
+        latch.append(self.MOSI_PIN)
+        return [cmd, latch]
 
 
 if __name__ == "__main__":